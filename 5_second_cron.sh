@@ -1,6 +1,6 @@
 #!/bin/bash
-while true
-do
- /usr/bin/python3 /home/eric/tplink_to_influxdb/app/collect.py
- /usr/bin/sleep 5
-done
+#
+# collect.py runs continuously, collecting every INTERVAL seconds
+#
+export INTERVAL=5
+exec /usr/bin/python3 /home/eric/tplink_to_influxdb/app/collect.py
@@ -15,107 +15,316 @@ import sys
 import time
 import yaml
 import inspect
+import requests
 
+from dataclasses import dataclass
 from influxdb import InfluxDBClient
 from kasa import SmartPlug
 from PyP100 import PyP110
 
 dirname = os.path.dirname(inspect.getfile(inspect.currentframe()))
-filename = os.path.join(dirname, '../example/config.yml')
+filename = os.getenv('CONF_FILE', os.path.join(dirname, '../example/config.yml'))
+
+# SmartPlug instances keyed by IP, kept so that python-kasa can reuse
+# the established connection on later polls
+_kasa_cache = {}
+
+# InfluxDB clients keyed by connection details, so that the underlying
+# HTTP connection pool survives between polling cycles
+_influx_clients = {}
+
+# Logged in PyP110 sessions keyed by IP and credentials, so that the handshake and login
+# don't need to be repeated on every poll
+_tapo_cache = {}
+
+@dataclass(slots=True, frozen=True)
+class Device:
+    ''' A smartplug to poll
+    '''
+    name: str
+    ip: str
+
+
+@dataclass(slots=True, frozen=True)
+class TapoConfig:
+    ''' Credentials and devices for the Tapo plugs
+    '''
+    user: str
+    passw: str
+    devices: tuple
+
+
+@dataclass(slots=True, frozen=True)
+class InfluxConfig:
+    ''' An InfluxDB output
+    '''
+    name: str
+    host: str
+    port: int
+    user: str
+    password: str
+    database: str
+
+
+@dataclass(slots=True, frozen=True)
+class Config:
+    ''' The parsed contents of the config file
+    '''
+    kasa: tuple
+    tapo: TapoConfig
+    influxdb: tuple
+    interval: float
+    concurrency: int
+
+
+@dataclass(slots=True)
+class Reading:
+    ''' Usage stats collected from a device
+    '''
+    today_usage: float
+    now_usage_w: float
+    time: int
+
+
+# Prefer the libyaml backed loader where it's available
+try:
+    YamlLoader = yaml.CSafeLoader
+except AttributeError:
+    YamlLoader = yaml.SafeLoader
+
+# The most recently parsed config, along with the mtime of the file it came from
+_config_cache = {"mtime": 0, "data": None}
 
 def load_config():
     ''' Read the config file
     
+    The parsed config is cached, and only re-read if the file has been modified.
+
+    If the modified file can't be read, the error is logged and the last good
+    config is returned instead (None if there isn't one yet)
     '''
-    with open(filename) as file:
-        try:
-            config = yaml.safe_load(file)
-        except yaml.YAMLError as e:
-            print(e)
-            config = False
-            
+    try:
+        mtime = os.stat(filename).st_mtime
+        if mtime == _config_cache["mtime"]:
+            return _config_cache["data"]
+
+        # Record the mtime up front, so that a bad file is only reported once
+        _config_cache["mtime"] = mtime
+        with open(filename) as file:
+            config = parse_config(yaml.load(file, Loader=YamlLoader))
+    except (OSError, yaml.YAMLError) as e:
+        print(e, file=sys.stderr)
+        return _config_cache["data"]
+    except (AttributeError, KeyError, TypeError, ValueError) as e:
+        print(f"Invalid config: {e!r}", file=sys.stderr)
+        return _config_cache["data"]
+
+    _config_cache["data"] = config
+    pruneCaches(config)
     return config
+
+
+def influxKey(influx):
+    ''' The key used to cache the client for an InfluxDB output
+    '''
+    return (influx.host, influx.port, influx.user, influx.password, influx.database)
+
+
+def pruneCaches(config):
+    ''' Drop cached clients and sessions which the config no longer uses
+
+    This includes any which were created with details that have since changed
+    '''
+    influx_keys = {influxKey(influx) for influx in config.influxdb}
+    for key in set(_influx_clients) - influx_keys:
+        _influx_clients.pop(key).close()
+
+    kasa_ips = {kasa.ip for kasa in config.kasa}
+    for ip in set(_kasa_cache) - kasa_ips:
+        del _kasa_cache[ip]
+
+    tapo_keys = {(tapo.ip, config.tapo.user, config.tapo.passw) for tapo in config.tapo.devices}
+    for key in set(_tapo_cache) - tapo_keys:
+        del _tapo_cache[key]
+
+
+def parse_config(raw):
+    ''' Convert the parsed YAML into a Config
+    '''
+    # An empty (or half written) file parses to None
+    if not isinstance(raw, dict):
+        raise ValueError("config must be a mapping")
+
+    # A missing or empty section just means there are no devices of that type
+    kasa = raw.get("kasa") or {}
+    tapo = raw.get("tapo") or {}
+    for section, value in (("kasa", kasa), ("tapo", tapo)):
+        if not isinstance(value, dict):
+            raise ValueError(f"{section} must be a mapping")
+
+    tapo_devices = tuple(Device(str(d["name"]), str(d["ip"])) for d in tapo.get("devices") or [])
+
+    # The INTERVAL environment variable takes precedence over the config file
+    interval = raw.get("interval", 60)
+    if os.getenv("INTERVAL"):
+        interval = float(os.getenv("INTERVAL"))
+    if isinstance(interval, bool) or not isinstance(interval, (int, float)) or interval < 0:
+        raise ValueError(f"interval must be a number of seconds, 0 or more (got {interval!r})")
+
+    concurrency = raw.get("concurrency", 16)
+    if isinstance(concurrency, bool) or not isinstance(concurrency, int) or concurrency < 1:
+        raise ValueError(f"concurrency must be a whole number, 1 or more (got {concurrency!r})")
+
+    return Config(
+        kasa=tuple(Device(str(d["name"]), str(d["ip"])) for d in kasa.get("devices") or []),
+        tapo=TapoConfig(
+            # Credentials are only needed if there's something to log into
+            user=tapo["user"] if tapo_devices else tapo.get("user"),
+            passw=tapo["passw"] if tapo_devices else tapo.get("passw"),
+            devices=tapo_devices
+            ),
+        influxdb=tuple(InfluxConfig(i["name"], i["host"], int(i["port"]), i["user"], i["password"], i["database"])
+                       for i in raw["influxdb"]),
+        interval=interval,
+        concurrency=concurrency
+        )
     
 
-def main():
+async def main():
     ''' Main Entry point
     
-    Read the config, initialise readers etc
+    Run as a long-lived process, reading the config and running a collection
+    every interval seconds. An interval of 0 runs a single collection and exits
     '''
 
+    # Only give up if we can't get a usable config at startup
     config = load_config()
     if not config:
         sys.exit(1)
+
+    while True:
+        start = time.monotonic()
+        try:
+            # Pick up any changes to the config, load_config falls back
+            # to the last good config if the file has been broken
+            config = load_config() or config
+            await run_once(config)
+            failed = False
+        except Exception as e:
+            # Log it and try again on the next tick, rather than taking the process down
+            print(f"Collection failed: {e!r}", file=sys.stderr)
+            failed = True
+
+        if not config.interval:
+            if failed:
+                sys.exit(1)
+            break
+
+        # Account for the time the collection took, so that runs don't drift
+        await asyncio.sleep(max(0, config.interval - (time.monotonic() - start)))
+
+
+async def run_once(config):
+    ''' Poll all of the configured devices and send the results on to InfluxDB
+    '''
     
-    # Create the InfluxDB clients
+    # Fetch (or create) the InfluxDB clients
     influxes = []
 
-    for influx in config["influxdb"]:
-            c = InfluxDBClient(influx["host"],influx["port"],influx["user"],influx["password"],influx["database"])
-            influxes.append({"name": influx['name'],
-                             "conn": c
+    for influx in config.influxdb:
+            key = influxKey(influx)
+            c = _influx_clients.get(key)
+            if c is None:
+                c = _influx_clients.setdefault(key, InfluxDBClient(*key))
+            influxes.append({"name": influx.name,
+                             "conn": c,
+                             "database": influx.database
                              })
 
     stats = {}
     start_time = time.time_ns()
 
-    for kasa in config["kasa"]["devices"]:
-        try:
-            now_usage_w, today_usage = poll_kasa(kasa['ip'])
-        except:
-            print(f"Failed to communicate with device {kasa['name']}.  Adding empty entry.")
-            now_usage_w = 0
-            today_usage = 1
+    kasa_devices = config.kasa
+    tapo_devices = config.tapo.devices
+
+    # Query the plugs concurrently rather than waiting on each in turn, but cap
+    # the number in flight so that large fleets don't open a flood of connections
+    #
+    # PyP100 is blocking, so the Tapo polls get pushed out to the default executor
+    loop = asyncio.get_running_loop()
+    sem = asyncio.Semaphore(config.concurrency)
+
+    async def guarded(poll, *args):
+        async with sem:
+            return await poll(*args)
+
+    tasks = [guarded(poll_kasa, kasa.ip) for kasa in kasa_devices]
+    tasks += [guarded(loop.run_in_executor, None, poll_tapo, tapo.ip, config.tapo.user, config.tapo.passw)
+              for tapo in tapo_devices]
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+
+    # Collect output for the run and write it out in one go at the end
+    lines = []
+
+    for i, (device, result) in enumerate(zip(kasa_devices + tapo_devices, results)):
+        is_kasa = i < len(kasa_devices)
+        now_usage_w, today_usage = pollResult(result)
+
         if now_usage_w is False:
-            print(f"Failed to communicate with device {kasa['name']}.  Adding empty entry.")
+            if not is_kasa:
+                lines.append(f"Failed to communicate with device {device.name}")
+                continue
+
+            lines.append(f"Failed to communicate with device {device.name}.  Adding empty entry.")
             now_usage_w = 0
             today_usage = 1
         
-        if today_usage == 0:
+        if is_kasa and today_usage == 0:
             today_usage = 1
         
-        print(f"Plug: {kasa['name']} using {now_usage_w}W, today: {today_usage} Wh")
-        stats[kasa['name']] = {
-                "today_usage" : today_usage,
-                "now_usage_w" : now_usage_w,
-                "time" : start_time
-            }
-
-    #for tapo in config["tapo"]["devices"]:
-    #    now_usage_w, today_usage = poll_tapo(tapo['ip'], config["tapo"]["user"], config["tapo"]["passw"])
-    #    if now_usage_w is False:
-    #        print(f"Failed to communicate with device {tapo['name']}")
-    #        continue
-    #    
-    #    print(f"Plug: {tapo['name']} using {now_usage_w}W, today: {today_usage/1000} kWh")
-    #    stats[tapo['name']] = {
-    #            "today_usage" : today_usage,
-    #            "now_usage_w" : now_usage_w,
-    #            "time" : start_time
-    #        }
+        lines.append(f"Plug: {device.name} using {now_usage_w}W, today: {today_usage} Wh")
+        stats[device.name] = Reading(today_usage, now_usage_w, start_time)
         
     # Build a buffer of points
-    points_buffer = buildPointsBuffer(stats)
+    points_buffer = b"".join(iterLines(stats))
+    num_points = points_buffer.count(b"\n")
     
-    if len(points_buffer) > 0:
-        # Iterate through the InfluxDB connections and send the data over
-        for dest in influxes:
-            res = sendToInflux(dest['conn'],
-                        points_buffer
-                        )
+    if num_points > 0:
+        # Send the data over to all of the InfluxDB connections at once
+        #
+        # The client is blocking, so the writes are run in the default executor
+        sent = await asyncio.gather(*(loop.run_in_executor(None, sendToInflux, dest['conn'], dest['database'], points_buffer)
+                                      for dest in influxes))
+        for dest, res in zip(influxes, sent):
             if not res:
-                print(f"Failed to send points to {dest['name']}")
+                lines.append(f"Failed to send points to {dest['name']}")
             else:
-                print(f"Wrote {len(points_buffer)} points to {dest['name']}")
+                lines.append(f"Wrote {num_points} points to {dest['name']}")
+
+    if lines:
+        sys.stdout.write("\n".join(lines) + "\n")
+        sys.stdout.flush()
+
+
+def pollResult(result):
+    ''' Unpack the result of a device poll
+
+    An exception raised by the poll is treated the same as a failed poll
+    '''
+    if isinstance(result, Exception):
+        return False, False
+    return result
 
         
-def poll_kasa(ip):
+async def poll_kasa(ip):
     ''' Poll a TP-Link Kasa smartplug
     
     TODO: need to add some exception handling to this
     '''
-    p = SmartPlug(ip)
-    asyncio.run(p.update())
+    p = _kasa_cache.get(ip)
+    if p is None:
+        p = _kasa_cache.setdefault(ip, SmartPlug(ip))
+    await p.update()
     # Connect to the plug and receive stats
     try:
         
@@ -139,76 +348,88 @@ def poll_kasa(ip):
     return now_usage_w, today_usage
 
 
-def poll_tapo(ip, user, passw):
-    ''' Poll a TP-Link Tapo smartplug
+def tapoLogin(ip, user, passw):
+    ''' Log into a TP-Link Tapo smartplug, caching the session for later polls
     '''
-    
-    try:
-        p110 = PyP110.P110(ip, user, passw)
-        p110.handshake() #Creates the cookies required for further methods
-        p110.login() #Sends credentials to the plug and creates AES Key and IV for further methods        
-        usage_dict = p110.getEnergyUsage()
-    except:
-        return False, False
+    p110 = PyP110.P110(ip, user, passw)
+    p110.handshake() #Creates the cookies required for further methods
+    p110.login() #Sends credentials to the plug and creates AES Key and IV for further methods
+    _tapo_cache[(ip, user, passw)] = p110
+    return p110
+
 
+def tapoUsage(p110):
+    ''' Fetch the usage readings from a logged in Tapo smartplug
+    '''
+    usage_dict = p110.getEnergyUsage()
     today_usage = usage_dict["result"]["today_energy"]
     now_usage_w = usage_dict["result"]["current_power"] / 1000
-    
     return now_usage_w, today_usage
-    
 
-def buildPointsBuffer(points):
-    ''' Iterate through the collected stats and write them out to InfluxDB
+
+def poll_tapo(ip, user, passw):
+    ''' Poll a TP-Link Tapo smartplug
+
+    The logged in session is cached and reused by later polls. If the plug
+    rejects it (usually because it has expired) we log in again and retry once
     '''
+    p110 = _tapo_cache.get((ip, user, passw))
+    if p110 is not None:
+        try:
+            return tapoUsage(p110)
+        except requests.RequestException:
+            # Couldn't reach the plug, the session itself should still be good
+            return False, False
+        except KeyError:
+            # A rejected request comes back without a result
+            pass
+        except Exception as e:
+            # PyP100 raises plain Exceptions for error codes returned by the plug.
+            # Anything more specific isn't a session problem, so let it through
+            if type(e) is not Exception:
+                raise
+
+        _tapo_cache.pop((ip, user, passw), None)
+
+    return tapoUsage(tapoLogin(ip, user, passw))
     
-    # Initialize
 
-    points_buffer = []
+def escapeKey(key):
+    ''' Escape a key for use in line protocol
+    '''
+    return key.replace("\\", "\\\\").replace(",", "\\,").replace("=", "\\=").replace(" ", "\\ ").replace("\n", "\\n")
+
+
+def iterLines(points):
+    ''' Iterate through the collected stats, yielding encoded line protocol to write out to InfluxDB
+    '''
     
-    for point in points:
+    for point, reading in points.items():
+        field = escapeKey(point)
              
         # Build a point 
-        dataPoint = {
-            "measurement": "Iotawatt",
-            #"tags": {
-            #    "host": point,
-            #},
-            "time": points[point]['time'],
-            "fields": {
-                point: float(points[point]['now_usage_w'])
-            }
-        }
-        #p = influxdb_client.Point("power_watts").tag("host", point).field("consumption", float(points[point]['now_usage_w'])).time(points[point]['time'])
-        points_buffer.append(dataPoint)
-        
+        yield f"Iotawatt {field}={float(reading.now_usage_w)} {reading.time}\n".encode()
         
         # If we've captured usage, add a point for that
-        if points[point]['today_usage']:
-            dataPoint = {
-            "measurement": "Iotawatt",
-            #"tags": {
-            #    "host": point,
-            #},
-            "time": points[point]['time'],
-            "fields": {
-                point+"_Wh": int(float(points[point]['today_usage']))
-            }
-            }
-            #p = influxdb_client.Point("power_watts").tag("host", point).field("watts_today", int(float(points[point]['today_usage']))).time(points[point]['time'])
-            points_buffer.append(dataPoint)
-        
-    return points_buffer
+        if reading.today_usage:
+            yield f"Iotawatt {field}_Wh={int(float(reading.today_usage))}i {reading.time}\n".encode()
 
 
-def sendToInflux(influxdb_client, points_buffer):
-    ''' Take a set of values, and send them on to InfluxDB
+def sendToInflux(influxdb_client, database, points_buffer):
+    ''' Take a buffer of line protocol, and send it on to InfluxDB
     '''
     try:
-        influxdb_client.write_points(points_buffer)
+        influxdb_client.request(url="write",
+                                method="POST",
+                                params={"db": database},
+                                data=points_buffer,
+                                expected_response_code=204,
+                                headers={"Content-Type": "text/plain; charset=utf-8"}
+                                )
         return True
     except:
         return False
 
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())
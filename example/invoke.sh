@@ -2,7 +2,8 @@
 #
 # Example invocation
 #
+# The container runs continuously, collecting every interval seconds
 #
 
 docker pull bentasker12/tplink_to_influxdb:latest
-docker run --rm --name="tplink_to_influxdb" -v $PWD/config.yml:/config.yml bentasker12/tplink_to_influxdb:latest
+docker run -d --restart=unless-stopped --name="tplink_to_influxdb" -v $PWD/config.yml:/config.yml bentasker12/tplink_to_influxdb:latest